@@ -0,0 +1,290 @@
+import gc
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import tracemalloc
+from collections import defaultdict
+from typing import Callable
+import colorama
+from pydantic import ValidationError
+from fsm_llm.state_models import FSMError
+
+from main import STREAMED_STATES, CompletionClient, CompletionError, GeminiOpenAIWrapper, MockResponse, build_fsm, api_key
+
+class RecordingClient:
+    """Wraps the Gemini client and keeps the raw text of every completion it returns."""
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.beta = self
+        self.chat = self
+        self.completions = self
+
+    async def parse(self, messages, response_format=None, **kwargs):
+        completion = await self.client.parse(messages, response_format=response_format, **kwargs)
+        self.calls.append(completion.choices[0].message.content)
+        return completion
+
+class ReplayClient(CompletionClient):
+    """Deterministic local stand-in for GeminiOpenAIWrapper: returns the recorded completions in order."""
+    def __init__(self, calls, delay: float = 0.0, chunk_size: int = 0):
+        super().__init__(stream=chunk_size > 0)
+        self.calls = iter(calls)
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.on_call: Callable[[], None] | None = None
+
+    async def _chunks(self, text: str):
+        for i in range(0, len(text), self.chunk_size):
+            await asyncio.sleep(0) # Lascia interlacciare le altre sessioni tra un chunk e l'altro
+            yield text[i:i + self.chunk_size]
+
+    async def parse(self, messages, response_format=None, **kwargs):
+        if self.on_call: self.on_call()
+        await asyncio.sleep(self.delay) # Anche con delay 0 cede il controllo, cosi' le sessioni si interlacciano
+        text = next(self.calls, None)
+        if text is None:
+            raise RuntimeError("Recording exhausted: the FSM asked for more completions than were recorded.")
+        if self.stream: text = await self._consume_stream(self._chunks(text), response_format)
+        return MockResponse(text, response_format)
+
+class LoadStats:
+    def __init__(self):
+        self.turns = 0
+        self.latency = defaultdict(list)
+        self.divergences = 0
+        self.failed_sessions = 0
+        self.mismatches = 0
+        self.previews = 0
+        self.missing_previews = 0
+        self.first_text = []
+
+    def add_turn(self, legs: list, started: float, ended: float):
+        # Ogni chiamata all'LLM apre una tratta, attribuita allo stato attivo in quel momento
+        self.turns += 1
+        bounds = [started] + [at for _, at in legs[1:]] + [ended]
+        for (leg_state, _), begin, end in zip(legs, bounds, bounds[1:]):
+            self.latency[leg_state].append(end - begin)
+
+def at_least(minimum, kind=int):
+    def parse(value: str):
+        number = kind(value)
+        if number < minimum: raise argparse.ArgumentTypeError(f"must be >= {minimum}, got {value}")
+        return number
+    return parse
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def read_inputs(path: str | None):
+    if path:
+        with open(path, encoding="utf-8") as f:
+            lines = [line.strip() for line in f]
+        # Accetta anche trascrizioni come output.txt, tenendo solo le battute del giocatore
+        if any(line.startswith("Traveler:") for line in lines):
+            lines = [line.split(":", 1)[1].strip() for line in lines if line.startswith("Traveler:")]
+        yield from lines
+    else:
+        while True:
+            try: yield input(f"{colorama.Fore.BLUE}Traveler{colorama.Fore.RESET}: ").strip()
+            except EOFError: return
+
+async def record(inputs_path: str | None, out_path: str):
+    fsm = build_fsm()
+    client = RecordingClient(GeminiOpenAIWrapper(api_key=api_key))
+    turns = []
+
+    async def turn(user_input: str):
+        state = fsm.get_curr_state()
+        run_state = await fsm.run_state_machine(client, user_input=user_input)
+        turns.append({
+            "user_input": user_input,
+            "state": state,
+            "next_state": fsm.get_curr_state(),
+            "completions": client.calls,
+            "response": str(run_state.response),
+        })
+        client.calls = []
+        print(f"{colorama.Fore.GREEN}{run_state.response}{colorama.Fore.RESET}")
+
+    user_input = "START"
+    try:
+        await turn(user_input)
+        for user_input in read_inputs(inputs_path):
+            if fsm.is_completed(): break
+            if not user_input or user_input.startswith("!"): continue
+            await turn(user_input)
+    except (CompletionError, FSMError, ValidationError) as e:
+        print(f"{colorama.Fore.RED}[RECORD ERROR]: turn {len(turns) + 1} ({user_input!r}) failed: {e}{colorama.Fore.RESET}")
+    finally:
+        # I turni gia' catturati vengono salvati anche se la registrazione si interrompe
+        if turns:
+            with open(out_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"turns": turns}) + "\n")
+        print(f"{colorama.Fore.MAGENTA}Recorded {len(turns)} turns to {out_path}{colorama.Fore.RESET}")
+
+async def replay_session(recording: dict, delay: float, chunk_size: int, stats: LoadStats):
+    fsm = build_fsm()
+    client = ReplayClient([c for t in recording["turns"] for c in t["completions"]], delay, chunk_size)
+    preview = []
+    def on_token(token: str):
+        if fsm.get_curr_state() not in STREAMED_STATES: return
+        if not preview: stats.first_text.append(time.perf_counter() - started)
+        preview.append(token)
+    client.on_token = on_token
+    legs = []
+    client.on_call = lambda: legs.append((fsm.get_curr_state(), time.perf_counter()))
+
+    for t in recording["turns"]:
+        state = fsm.get_curr_state()
+        preview.clear()
+        legs.clear()
+        started = time.perf_counter()
+        try:
+            run_state = await fsm.run_state_machine(client, user_input=t["user_input"])
+        except (ValidationError, FSMError, RuntimeError):
+            # Dopo una transizione diversa le completion registrate non combaciano piu': si ferma solo questa sessione
+            stats.divergences += 1
+            stats.failed_sessions += 1
+            return
+        stats.add_turn(legs, started, time.perf_counter())
+        if state != t["state"] or fsm.get_curr_state() != t["next_state"]: stats.divergences += 1
+        if str(run_state.response) != t["response"]: stats.mismatches += 1
+        if chunk_size and not preview and any(s in STREAMED_STATES for s, _ in legs): stats.missing_previews += 1
+        if preview:
+            # Il testo mostrato in anteprima deve comparire nella risposta finale
+            stats.previews += 1
+            if "".join(preview) not in str(run_state.response): stats.divergences += 1
+
+def _snapshot() -> tracemalloc.Snapshot:
+    # Esclude tracemalloc, l'event loop e l'harness: resta solo FSM + logica di gioco
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, os.path.join(os.path.dirname(asyncio.__file__), "*")),
+        tracemalloc.Filter(False, __file__),
+    ])
+
+async def trace_session(recording: dict, allocs: dict):
+    fsm = build_fsm()
+    client = ReplayClient([c for t in recording["turns"] for c in t["completions"]])
+    leg = {}
+    def open_leg():
+        leg.clear() # Libera la snapshot precedente prima di leggere la memoria di partenza
+        leg.update(state=fsm.get_curr_state(), snapshot=_snapshot())
+        leg["current"] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    def close_leg():
+        peak = tracemalloc.get_traced_memory()[1] - leg["current"]
+        diff = _snapshot().compare_to(leg["snapshot"], "filename")
+        allocs[leg["state"]].append((sum(d.count_diff for d in diff), sum(d.size_diff for d in diff), peak))
+    calls = 0
+    def on_call():
+        nonlocal calls
+        calls += 1
+        if calls > 1: # La prima tratta parte dall'inizio del turno
+            close_leg()
+            open_leg()
+    client.on_call = on_call
+
+    for t in recording["turns"]:
+        calls = 0
+        open_leg()
+        try:
+            await fsm.run_state_machine(client, user_input=t["user_input"])
+        except (ValidationError, FSMError, RuntimeError):
+            return # Le divergenze sono gia' contate dal passaggio concorrente
+        close_leg()
+
+async def allocation_pass(recordings: list) -> dict:
+    """Replays each recording once more, one session at a time, tracing allocations per LLM call."""
+    allocs = defaultdict(list)
+    for recording in recordings: await replay_session(recording, 0, 0, LoadStats()) # Riscaldamento: cache e schemi
+    gc.disable()
+    tracemalloc.start()
+    try:
+        for recording in recordings: await trace_session(recording, allocs)
+    finally:
+        tracemalloc.stop()
+        gc.enable()
+    return allocs
+
+async def replay(recordings_path: str, sessions: int, concurrency: int, delay: float, chunk_size: int) -> LoadStats:
+    with open(recordings_path, encoding="utf-8") as f:
+        recordings = [json.loads(line) for line in f if line.strip()]
+    if not recordings: raise SystemExit(f"No recordings found in {recordings_path}")
+
+    stats = LoadStats()
+    limit = asyncio.Semaphore(concurrency)
+    async def bounded(i: int):
+        async with limit: await replay_session(recordings[i % len(recordings)], delay, chunk_size, stats)
+
+    collections = sum(s["collections"] for s in gc.get_stats())
+    started = time.perf_counter()
+    await asyncio.gather(*(bounded(i) for i in range(sessions)))
+    elapsed = time.perf_counter() - started
+    collections = sum(s["collections"] for s in gc.get_stats()) - collections
+
+    turns = stats.turns
+    print(f"{colorama.Fore.MAGENTA}--- Replay: {sessions} sessions, concurrency {concurrency}, mock delay {delay * 1000:.0f}ms ---{colorama.Fore.RESET}")
+    print(f"Turns: {turns} in {elapsed:.2f}s ({turns / elapsed:.1f} turns/sec), GC collections: {collections}")
+    print(f"{'STATE':<12}{'CALLS':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for state, values in sorted(stats.latency.items()):
+        print(f"{state:<12}{len(values):>7}{percentile(values, 50) * 1000:>10.3f}{percentile(values, 95) * 1000:>10.3f}"
+              f"{percentile(values, 99) * 1000:>10.3f}")
+
+    allocs = await allocation_pass(recordings)
+    print(f"{colorama.Fore.MAGENTA}--- Allocations: sequential pass, one session at a time, GC disabled ---{colorama.Fore.RESET}")
+    print(f"{'STATE':<12}{'CALLS':>7}{'new blocks':>12}{'new KiB':>10}{'peak KiB':>10}")
+    for state, values in sorted(allocs.items()):
+        count, size, peak = (sum(v[i] for v in values) / len(values) for i in range(3))
+        print(f"{state:<12}{len(values):>7}{count:>12.0f}{size / 1024:>10.1f}{peak / 1024:>10.1f}")
+    if chunk_size:
+        first_text = f"p50 {percentile(stats.first_text, 50) * 1000:.3f}ms" if stats.first_text else "never shown"
+        print(f"Streamed previews ({chunk_size}-char chunks): {stats.previews} turns, TTFT {first_text}")
+        if stats.missing_previews:
+            print(f"{colorama.Fore.RED}[STREAM]: {stats.missing_previews} turns in {', '.join(sorted(STREAMED_STATES))} "
+                  f"showed no preview{colorama.Fore.RESET}")
+    if stats.divergences:
+        print(f"{colorama.Fore.RED}[DIVERGENCE]: {stats.divergences} turns did not follow the recorded transitions "
+              f"({stats.failed_sessions} sessions stopped early){colorama.Fore.RESET}")
+    if stats.mismatches:
+        print(f"{colorama.Fore.RED}[MISMATCH]: {stats.mismatches} turns replied differently from the recording{colorama.Fore.RESET}")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Record/replay load test for Baba's FSM+LLM NPC.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rec = commands.add_parser("record", help="Play a conversation against Gemini and store it.")
+    rec.add_argument("--inputs", help="File with one user input per line (or a transcript like output.txt). Defaults to stdin.")
+    rec.add_argument("--out", default="recordings.jsonl")
+
+    rep = commands.add_parser("replay", help="Replay recordings concurrently against a local mock of Gemini.")
+    rep.add_argument("recordings", nargs="?", default="recordings.jsonl")
+    rep.add_argument("--sessions", type=at_least(1), default=100)
+    rep.add_argument("--concurrency", type=at_least(1), default=10)
+    rep.add_argument("--delay", type=at_least(0, float), default=0.0,
+                     help="Simulated LLM latency in ms. Every mock call yields to the event loop, "
+                          "so sessions interleave even at 0 and turns/sec reflects concurrent replay.")
+    rep.add_argument("--stream", type=at_least(0), default=0, metavar="CHUNK_SIZE",
+                     help="Replay completions as a stream of CHUNK_SIZE chars and check the free-form previews.")
+    rep.add_argument("--max-p95", type=float, help="Fail if any state's p95 latency (ms) exceeds this value.")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        asyncio.run(record(args.inputs, args.out))
+        return
+
+    stats = asyncio.run(replay(args.recordings, args.sessions, args.concurrency, args.delay / 1000, args.stream))
+    slow = [s for s, v in stats.latency.items() if args.max_p95 is not None and percentile(v, 95) * 1000 > args.max_p95]
+    if slow:
+        print(f"{colorama.Fore.RED}[REGRESSION]: p95 over {args.max_p95}ms in {', '.join(sorted(slow))}{colorama.Fore.RESET}")
+    if slow or stats.divergences or stats.mismatches or stats.missing_previews: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,97 @@
 import os
+import re
+import json
+import time
 import asyncio
 from dotenv import load_dotenv
 import google.genai as genai
 from google.genai import types
 from pydantic import BaseModel
 import colorama
-from typing import Dict, List
+from typing import Callable, Dict, List
 
 from fsm_llm import LLMStateMachine
-from fsm_llm.state_models import FSMRun
+from fsm_llm.state_models import FSMRun, DefaultResponse, ImmediateStateChange
 
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
-
-class GeminiOpenAIWrapper:
-    def __init__(self, api_key: str, model_id: str = "gemini-2.5-flash"):
-        self.client = genai.Client(api_key=api_key)
-        self.model_id = model_id
+stream_replies = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+
+# Stati il cui testo libero viene mostrato mentre arriva (gli altri sostituiscono la risposta del modello)
+STREAMED_STATES = {"QUEST_OFFER"}
+
+def is_free_form(response_format) -> bool:
+    field = response_format.model_fields.get("response") if response_format else None
+    return field is not None and field.annotation is DefaultResponse
+
+def partial_json_string(buffer: str, key: str) -> str:
+    """Decodes the (possibly unterminated) string value of `key` in a partial JSON buffer."""
+    match = re.search(rf'"{key}"\s*:\s*"', buffer)
+    if not match: return ""
+    raw, i = [], match.end()
+    while i < len(buffer):
+        c = buffer[i]
+        if c == '"': break
+        if c == "\\":
+            size = 6 if buffer[i + 1:i + 2] == "u" else 2
+            if i + size > len(buffer): break # Escape troncato, arriva col prossimo chunk
+            raw.append(buffer[i:i + size])
+            i += size
+            continue
+        raw.append(c)
+        i += 1
+    text = json.loads('"' + "".join(raw) + '"', strict=False)
+    if text and "\ud800" <= text[-1] <= "\udbff": text = text[:-1] # Surrogate pair incompleta
+    return text
+
+class CompletionError(Exception):
+    """Raised when the LLM call fails, so the turn is dropped instead of validating an empty reply."""
+    pass
+
+class ParsedMessage:
+    def __init__(self, text, model):
+        self.content = text
+        self.parsed = model.model_validate_json(text) if model and text != "{}" else None
+class MockChoice:
+    def __init__(self, text, model):
+        self.message = ParsedMessage(text, model)
+class MockResponse:
+    def __init__(self, text, model):
+        self.choices = [MockChoice(text, model)]
+
+class CompletionClient:
+    """Base for the OpenAI-shaped clients handed to the FSM: shared streaming and timing logic."""
+    def __init__(self, stream: bool = False):
+        self.stream = stream
+        self.on_token: Callable[[str], None] | None = None
+        self.first_chunk_at: float | None = None
         self.beta = self
         self.chat = self
         self.completions = self
 
+    async def _consume_stream(self, texts, response_format) -> str:
+        # Il JSON strutturato viene validato solo a fine stream, qui si inoltra solo il testo libero
+        on_token = self.on_token if is_free_form(response_format) else None
+        text_out, shown = "", ""
+        async for text in texts:
+            if self.first_chunk_at is None: self.first_chunk_at = time.perf_counter()
+            text_out += text
+            if not on_token: continue
+            try:
+                partial = partial_json_string(text_out, "content")
+            except ValueError:
+                continue # L'anteprima salta questo chunk, la risposta completa resta valida
+            if len(partial) > len(shown):
+                on_token(partial[len(shown):])
+                shown = partial
+        return text_out
+
+class GeminiOpenAIWrapper(CompletionClient):
+    def __init__(self, api_key: str, model_id: str = "gemini-2.5-flash", stream: bool = False):
+        super().__init__(stream)
+        self.client = genai.Client(api_key=api_key)
+        self.model_id = model_id
+
     async def parse(self, messages, response_format=None, **kwargs):
         prompt = messages[-1]["content"]
         config = types.GenerateContentConfig(
@@ -29,24 +100,17 @@ class GeminiOpenAIWrapper:
             response_schema=response_format if response_format else None,
         )
         try:
-            response = await asyncio.to_thread(
-                lambda: self.client.models.generate_content(model=self.model_id, contents=prompt, config=config)
-            )
-            text_out = response.text
+            if self.stream:
+                stream = await self.client.aio.models.generate_content_stream(model=self.model_id, contents=prompt, config=config)
+                text_out = await self._consume_stream((chunk.text or "" async for chunk in stream), response_format)
+            else:
+                response = await asyncio.to_thread(
+                    lambda: self.client.models.generate_content(model=self.model_id, contents=prompt, config=config)
+                )
+                text_out = response.text
+                if self.first_chunk_at is None: self.first_chunk_at = time.perf_counter()
         except Exception as e:
-            print(f"{colorama.Fore.RED}[API ERROR]: {e}{colorama.Fore.RESET}")
-            text_out = "{}" if response_format else "..."
-
-        class ParsedMessage:
-            def __init__(self, text, model):
-                self.content = text
-                self.parsed = model.model_validate_json(text) if model and text != "{}" else None
-        class MockChoice:
-            def __init__(self, text, model):
-                self.message = ParsedMessage(text, model)
-        class MockResponse:
-            def __init__(self, text, model):
-                self.choices = [MockChoice(text, model)]
+            raise CompletionError(e) from e
         return MockResponse(text_out, response_format)
 
 class Item(BaseModel):
@@ -67,24 +131,7 @@ class ActionResponseModel(BaseModel):
     item_id: str | None = None
     amount: int = 1
 
-fsm = LLMStateMachine(initial_state="GREETING", end_state="END")
-
-# DATABASE OGGETTI
-fsm.set_context_data("items", {
-    "healing-potion": Item(id="healing-potion", name="Healing Potion", description="A bubbling red liquid.", effect="Restores 50 HP immediately."),
-    "defense-potion": Item(id="defense-potion", name="Defense Potion", description="Thick and smells like earth.", effect="+20 Physical Resistance for 5 min."),
-    "acorn": Item(id="acorn", name="Acorn", description="An acorn kissed by moonlight.", effect="Basic reagent for earth potions."),
-    "goblin-bone": Item(id="goblin-bone", name="Goblin Bone", description="Rattling remains.", effect="Contains trace amounts of chaotic energy."),
-    "vial": Item(id="vial", name="Empty Vial", description="Clear glass.", effect="Required to hold any liquid creation.")
-})
-
-fsm.set_context_data("prices", {"healing-potion": 30, "acorn": 5, "goblin-bone": 10, "vial": 2})
-fsm.set_context_data("recipes", {"defense-potion": Recipe(result_id="defense-potion", ingredients={"acorn": 1, "goblin-bone": 1, "vial": 1})})
-
-fsm.set_context_data("player", {"money": 100, "inventory": [ItemAmount(id="acorn", amount=3), ItemAmount(id="vial", amount=5)]})
-fsm.set_context_data("witch", {"name": "Baba", "quest_given": False})
-
-def resolve_item_id(input_id: str | None) -> str | None:
+def resolve_item_id(fsm: LLMStateMachine, input_id: str | None) -> str | None:
     if not input_id: return None
     items = fsm.get_context_data("items")
     clean = input_id.lower().strip().rstrip('s') # Gestione plurali
@@ -92,7 +139,11 @@ def resolve_item_id(input_id: str | None) -> str | None:
         if clean == k or clean in v.name.lower(): return k
     return None
 
-def print_inventory():
+def remember_input(user_input: str, fsm: LLMStateMachine) -> None:
+    # Hook preprocess_input: conserva le parole del giocatore senza modificarle
+    fsm.set_context_data("last_input", user_input)
+
+def print_inventory(fsm: LLMStateMachine):
     p = fsm.get_context_data("player")
     it = fsm.get_context_data("items")
     res = f"\n{colorama.Fore.YELLOW}--- BAG (Gold: {p['money']}) ---{colorama.Fore.RESET}\n"
@@ -100,136 +151,194 @@ def print_inventory():
         res += f" * {it[s.id].name}: {s.amount}\n"
     return res
 
-@fsm.define_state(
-    state_key="GREETING",
-    prompt_template="You are Baba. Identify intent: BUY, BREW, IDENTIFY, END, or TALK (for quest/chat).",
-    transitions={"BREW": "Brew", "BUY": "Buy", "IDENTIFY": "Iden", "TALK": "Talk", "END": "Exit"}
-)
-async def greeting_state(fsm, **kwargs):
-    witch = fsm.get_context_data("witch")
-    if not kwargs.get('will_transition', False):
-        return "Baba: *Cackle*... I smell sulfur and potential. What brings you to my hut? I sell reagents, brew potions, and identify artifacts."
-
-    ns = fsm.get_next_state()
-    if not witch["quest_given"] and ns == "TALK": fsm.set_next_state("QUEST_OFFER")
-    if ns == "IDENTIFY": return "Baba: 1 gold coin to reveal secrets. What shall I inspect?"
-    if ns == "BREW": return "Baba: I can brew a Defense Potion if you have an acorn, a bone, and a vial. Shall we?"
-    if ns == "BUY": return "Baba: My shelves are full. I have vials (2g), acorns (5g), bones (10g) and healing potions (30g)."
-    return "Baba: Speak quickly, time is bubbling away."
-
-@fsm.define_state(
-    state_key="IDENTIFY",
-    prompt_template="Identify item. Extract 'item_id'. If user cancels, return null.",
-    transitions={"GREETING": "Back", "IDENTIFY": "Loop"},
-    response_model=ActionResponseModel
-)
-async def identify_state(fsm, response, **kwargs):
-    player = fsm.get_context_data("player")
-    item_id = resolve_item_id(response.item_id)
-    if not item_id:
+def build_fsm() -> LLMStateMachine:
+    fsm = LLMStateMachine(initial_state="GREETING", end_state="END")
+
+    # DATABASE OGGETTI
+    fsm.set_context_data("items", {
+        "healing-potion": Item(id="healing-potion", name="Healing Potion", description="A bubbling red liquid.", effect="Restores 50 HP immediately."),
+        "defense-potion": Item(id="defense-potion", name="Defense Potion", description="Thick and smells like earth.", effect="+20 Physical Resistance for 5 min."),
+        "acorn": Item(id="acorn", name="Acorn", description="An acorn kissed by moonlight.", effect="Basic reagent for earth potions."),
+        "goblin-bone": Item(id="goblin-bone", name="Goblin Bone", description="Rattling remains.", effect="Contains trace amounts of chaotic energy."),
+        "vial": Item(id="vial", name="Empty Vial", description="Clear glass.", effect="Required to hold any liquid creation.")
+    })
+
+    fsm.set_context_data("prices", {"healing-potion": 30, "acorn": 5, "goblin-bone": 10, "vial": 2})
+    fsm.set_context_data("recipes", {"defense-potion": Recipe(result_id="defense-potion", ingredients={"acorn": 1, "goblin-bone": 1, "vial": 1})})
+
+    fsm.set_context_data("player", {"money": 100, "inventory": [ItemAmount(id="acorn", amount=3), ItemAmount(id="vial", amount=5)]})
+    fsm.set_context_data("witch", {"name": "Baba", "quest_given": False})
+
+    @fsm.define_state(
+        state_key="GREETING",
+        prompt_template="You are Baba. Identify intent: BUY, BREW, IDENTIFY, END, or QUEST_OFFER (for quest/chat).",
+        transitions={"BREW": "Brew", "BUY": "Buy", "IDENTIFY": "Iden", "QUEST_OFFER": "Talk", "END": "Exit"},
+        preprocess_input=remember_input
+    )
+    async def greeting_state(fsm, **kwargs):
+        witch = fsm.get_context_data("witch")
+        if not kwargs.get('will_transition', False):
+            return "Baba: *Cackle*... I smell sulfur and potential. What brings you to my hut? I sell reagents, brew potions, and identify artifacts."
+
+        ns = fsm.get_next_state()
+        if ns == "QUEST_OFFER":
+            if witch["quest_given"]: fsm.set_next_state("GREETING")
+            # La quest viene generata nello stesso turno, cosi' il suo testo puo' essere mostrato in streaming
+            else: return ImmediateStateChange(next_state="QUEST_OFFER", input=fsm.get_context_data("last_input"))
+        if ns == "IDENTIFY": return "Baba: 1 gold coin to reveal secrets. What shall I inspect?"
+        if ns == "BREW": return "Baba: I can brew a Defense Potion if you have an acorn, a bone, and a vial. Shall we?"
+        if ns == "BUY": return "Baba: My shelves are full. I have vials (2g), acorns (5g), bones (10g) and healing potions (30g)."
+        return "Baba: Speak quickly, time is bubbling away."
+
+    @fsm.define_state(
+        state_key="IDENTIFY",
+        prompt_template="Identify item. Extract 'item_id'. If user cancels, return null.",
+        transitions={"GREETING": "Back", "IDENTIFY": "Loop"},
+        response_model=ActionResponseModel
+    )
+    async def identify_state(fsm, response, **kwargs):
+        player = fsm.get_context_data("player")
+        item_id = resolve_item_id(fsm, response.item_id)
+        if not item_id:
+            fsm.set_next_state("GREETING")
+            return "Baba: Changed your mind? Hmph. Don't waste my sight."
+        if player["money"] < 1:
+            fsm.set_next_state("GREETING")
+            return "Baba: No gold, no wisdom. Get out."
+
+        player["money"] -= 1
+        item = fsm.get_context_data("items")[item_id]
         fsm.set_next_state("GREETING")
-        return "Baba: Changed your mind? Hmph. Don't waste my sight."
-    if player["money"] < 1:
+        return f"Baba: *Peers into a crystal*... Ah, the {item.name}. {item.effect} Anything else?"
+
+    @fsm.define_state(
+        state_key="BUY",
+        prompt_template="User wants to buy. Extract 'item_id' and 'amount'.",
+        transitions={"BUY_OK": "Success", "GREETING": "Back", "BUY": "Retry"},
+        response_model=ActionResponseModel
+    )
+    async def buy_state(fsm, response, **kwargs):
+        item_id = resolve_item_id(fsm, response.item_id)
+        if not item_id: return "Baba: I don't sell that! Look at my shelves: vials, potions, bones, and acorns."
+
+        player = fsm.get_context_data("player")
+        price = fsm.get_context_data("prices").get(item_id, 99) * response.amount
+
+        if player["money"] < price:
+            fsm.set_next_state("GREETING")
+            return f"Baba: {price} gold? You're a beggar! Come back when you're rich."
+
+        player["money"] -= price
+        # Update inventory
+        found = False
+        for s in player["inventory"]:
+            if s.id == item_id:
+                s.amount += response.amount
+                found = True
+                break
+        if not found: player["inventory"].append(ItemAmount(id=item_id, amount=response.amount))
+
+        fsm.set_next_state("BUY_OK")
+        return f"Baba: Fine. Take your {item_id}. Keep the change, I don't want your filth."
+
+    @fsm.define_state(state_key="BUY_OK", prompt_template="Done", transitions={"GREETING": "Back"})
+    async def buy_ok(fsm, **kwargs): return "Baba: Do you need more, or can I go back to my brew?"
+
+    @fsm.define_state(
+        state_key="BREW",
+        prompt_template="User wants to brew 'defense-potion'. Extract 'item_id'.",
+        transitions={"GREETING": "Cancel", "BREW_OK": "Success", "BREW": "Retry"},
+        response_model=ActionResponseModel
+    )
+    async def brew_state(fsm, response, **kwargs):
+        item_id = resolve_item_id(fsm, response.item_id)
+        if item_id != "defense-potion": return "Baba: I only brew Defense Potions for travelers!"
+
+        recipe = fsm.get_context_data("recipes")[item_id]
+        player = fsm.get_context_data("player")
+
+        # Check ingredients
+        for ing_id, count in recipe.ingredients.items():
+            if next((s.amount for s in player["inventory"] if s.id == ing_id), 0) < count:
+                return f"Baba: You're missing the {ing_id}! Check your bag."
+
+        # Consume ingredients
+        fsm.set_next_state("BREW_OK")
+        for ing_id, count in recipe.ingredients.items():
+            for i, s in enumerate(player["inventory"]):
+                if s.id == ing_id:
+                    s.amount -= count
+                    if s.amount <= 0: del player["inventory"][i]
+
+        player["inventory"].append(ItemAmount(id=item_id, amount=1))
+        return "Baba: *Stirs the pot vigorously*... There! A fresh Defense Potion. Careful, it's hot."
+
+    @fsm.define_state(state_key="BREW_OK", prompt_template="Done", transitions={"GREETING": "Back"})
+    async def brew_ok(fsm, **kwargs): return "Baba: My cauldron is still warm. Want another?"
+
+    @fsm.define_state(state_key="QUEST_OFFER", prompt_template="Offer quest for 'Magic Mushroom'.", transitions={"GREETING": "Done"})
+    async def quest_offer_state(fsm, response, **kwargs):
+        fsm.get_context_data("witch")["quest_given"] = True
         fsm.set_next_state("GREETING")
-        return "Baba: No gold, no wisdom. Get out."
-
-    player["money"] -= 1
-    item = fsm.get_context_data("items")[item_id]
-    fsm.set_next_state("GREETING")
-    return f"Baba: *Peers into a crystal*... Ah, the {item.name}. {item.effect} Anything else?"
-
-@fsm.define_state(
-    state_key="BUY",
-    prompt_template="User wants to buy. Extract 'item_id' and 'amount'.",
-    transitions={"BUY_OK": "Success", "GREETING": "Back", "BUY": "Retry"},
-    response_model=ActionResponseModel
-)
-async def buy_state(fsm, response, **kwargs):
-    item_id = resolve_item_id(response.item_id)
-    if not item_id: return "Baba: I don't sell that! Look at my shelves: vials, potions, bones, and acorns."
-
-    player = fsm.get_context_data("player")
-    price = fsm.get_context_data("prices").get(item_id, 99) * response.amount
-
-    if player["money"] < price:
-        fsm.set_next_state("GREETING")
-        return f"Baba: {price} gold? You're a beggar! Come back when you're rich."
-
-    player["money"] -= price
-    # Update inventory
-    found = False
-    for s in player["inventory"]:
-        if s.id == item_id:
-            s.amount += response.amount
-            found = True
-            break
-    if not found: player["inventory"].append(ItemAmount(id=item_id, amount=response.amount))
-
-    fsm.set_next_state("BUY_OK")
-    return f"Baba: Fine. Take your {item_id}. Keep the change, I don't want your filth."
-
-@fsm.define_state(state_key="BUY_OK", prompt_template="Done", transitions={"GREETING": "Back"})
-async def buy_ok(fsm, **kwargs): return "Baba: Do you need more, or can I go back to my brew?"
-
-@fsm.define_state(
-    state_key="BREW",
-    prompt_template="User wants to brew 'defense-potion'. Extract 'item_id'.",
-    transitions={"GREETING": "Cancel", "BREW_OK": "Success", "BREW": "Retry"},
-    response_model=ActionResponseModel
-)
-async def brew_state(fsm, response, **kwargs):
-    item_id = resolve_item_id(response.item_id)
-    if item_id != "defense-potion": return "Baba: I only brew Defense Potions for travelers!"
-
-    recipe = fsm.get_context_data("recipes")[item_id]
-    player = fsm.get_context_data("player")
-
-    # Check ingredients
-    for ing_id, count in recipe.ingredients.items():
-        if next((s.amount for s in player["inventory"] if s.id == ing_id), 0) < count:
-            return f"Baba: You're missing the {ing_id}! Check your bag."
-
-    # Consume ingredients
-    fsm.set_next_state("BREW_OK")
-    for ing_id, count in recipe.ingredients.items():
-        for i, s in enumerate(player["inventory"]):
-            if s.id == ing_id:
-                s.amount -= count
-                if s.amount <= 0: del player["inventory"][i]
-
-    player["inventory"].append(ItemAmount(id=item_id, amount=1))
-    return "Baba: *Stirs the pot vigorously*... There! A fresh Defense Potion. Careful, it's hot."
-
-@fsm.define_state(state_key="BREW_OK", prompt_template="Done", transitions={"GREETING": "Back"})
-async def brew_ok(fsm, **kwargs): return "Baba: My cauldron is still warm. Want another?"
-
-@fsm.define_state(state_key="QUEST_OFFER", prompt_template="Offer quest for 'Magic Mushroom'.", transitions={"GREETING": "Done"})
-async def quest_offer_state(fsm, response, **kwargs):
-    fsm.get_context_data("witch")["quest_given"] = True
-    return f"Baba: {response}\n{colorama.Fore.CYAN}[QUEST: THE MOONGLOW MUSHROOM]{colorama.Fore.RESET}"
-
-@fsm.define_state(state_key="END", prompt_template="Bye", transitions={})
-async def end_state(fsm, **kwargs): return "Baba: Begone! My hut needs to stretch its legs."
+        return f"Baba: {response}\n{colorama.Fore.CYAN}[QUEST: THE MOONGLOW MUSHROOM]{colorama.Fore.RESET}"
+
+    @fsm.define_state(state_key="END", prompt_template="Bye", transitions={})
+    async def end_state(fsm, **kwargs): return "Baba: Begone! My hut needs to stretch its legs."
+
+    return fsm
+
+async def npc_turn(fsm: LLMStateMachine, client: CompletionClient, user_input: str) -> FSMRun | None:
+    streamed, first_text_at = [], None
+    def show_token(token: str):
+        nonlocal first_text_at
+        # Lo stato va letto qui: un ImmediateStateChange puo' cambiarlo a meta' turno
+        if fsm.get_curr_state() not in STREAMED_STATES: return
+        if not streamed:
+            first_text_at = time.perf_counter()
+            print(f"{colorama.Fore.GREEN}Baba: ", end="")
+        streamed.append(token)
+        print(token, end="", flush=True)
+
+    client.on_token = show_token if client.stream else None
+    client.first_chunk_at = None
+    started = time.perf_counter()
+    try:
+        run_state = await fsm.run_state_machine(client, user_input=user_input)
+    except CompletionError as e:
+        if streamed: print(colorama.Fore.RESET) # Chiude la riga dell'anteprima interrotta
+        print(f"{colorama.Fore.RED}[API ERROR]: {e}{colorama.Fore.RESET}")
+        return None
+    turn_latency = time.perf_counter() - started
+
+    if run_state:
+        reply, text = str(run_state.response), "".join(streamed)
+        _, found, tail = reply.partition(text) if text else ("", "", "")
+        if found: print(f"{tail}{colorama.Fore.RESET}") # Completa il testo gia' mostrato (es. banner della quest)
+        else:
+            if text: print(colorama.Fore.RESET)
+            print(f"{colorama.Fore.GREEN}{reply}{colorama.Fore.RESET}")
+    if client.stream:
+        since = lambda t: f"{t - started:.2f}s" if t is not None else "n/a"
+        print(f"{colorama.Fore.LIGHTBLACK_EX}[TTFT: {since(first_text_at)} (first chunk: {since(client.first_chunk_at)}) | turn: {turn_latency:.2f}s]{colorama.Fore.RESET}")
+    return run_state
 
 async def main():
-    client = GeminiOpenAIWrapper(api_key=api_key)
+    fsm = build_fsm()
+    client = GeminiOpenAIWrapper(api_key=api_key, stream=stream_replies)
     print(f"{colorama.Fore.MAGENTA}--- Baba's Hut ---{colorama.Fore.RESET}")
     print(f"{colorama.Fore.MAGENTA}Type !inventory to see your gold and items.{colorama.Fore.RESET}")
 
     # Avvio automatico
-    run_state = await fsm.run_state_machine(client, user_input="START")
-    print(f"{colorama.Fore.GREEN}{run_state.response}{colorama.Fore.RESET}")
+    await npc_turn(fsm, client, "START")
 
     while not fsm.is_completed():
         user_input = input(f"{colorama.Fore.BLUE}Traveler{colorama.Fore.RESET}: ").strip()
         if not user_input: continue
         if user_input.startswith("!"):
-            if "inventory" in user_input: print(print_inventory())
+            if "inventory" in user_input: print(print_inventory(fsm))
             continue
 
-        run_state = await fsm.run_state_machine(client, user_input=user_input)
-        if run_state:
-            print(f"{colorama.Fore.GREEN}{run_state.response}{colorama.Fore.RESET}")
+        await npc_turn(fsm, client, user_input)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file